@@ -44,6 +44,32 @@ FILTER_MODELS = [
 # Model for the "model judge" fallback plan
 JUDGE_MODEL = "qwen-turbo" # qwen2.5-72b-instruct
 
+# Test: Models evaluated on the multiple choice questions (leaderboard)
+TEST_MODELS = [
+    "o4-mini",
+    "deepseek-r1-0528",
+    "gemini-2.5-pro-preview-05-06",
+    "qwen-max",
+    "gpt-4.1",
+    "claude-3-sonnet-20240229",
+]
+
+# --- Context Window Configuration ---
+# Context window (in tokens) per model; the longest key contained in the model name wins.
+MODEL_CONTEXT_LIMITS = {
+    "gpt-4.1": 1047576,
+    "o3": 200000,
+    "o4-mini": 200000,
+    "deepseek": 65536,
+    "qwen-turbo": 1000000,
+    "qwen-max": 32768,
+    "gemini": 1048576,
+    "claude": 200000,
+}
+DEFAULT_CONTEXT_LIMIT = 32768
+RESPONSE_TOKEN_RESERVE = 8192     # Tokens kept free for the model's response
+CONTEXT_OVERFLOW_POLICY = "reject"  # "reject" oversized requests before sending, or "truncate" them to fit
+
 # --- Pipeline Parameter Configuration ---
 NUM_TO_GENERATE = 6  # Number of error versions to be produced by each generation model
 NUM_TO_SAMPLE = 2    # Number to be randomly sampled from the generated error versions
@@ -51,10 +77,22 @@ NUM_TO_SAMPLE = 2    # Number to be randomly sampled from the generated error ve
 JUDGEMENT_RUNS_PER_MODEL = 3  # Number of judgment runs for the same question by each filter model
 QUALIFIED_SCORE_MIN = 4       # Minimum score for a qualified question (total of len(FILTER_MODELS) * JUDGEMENT_RUNS_PER_MODEL runs)
 QUALIFIED_SCORE_MAX = 7      # Maximum score for a qualified question
+SEED_QUALITY_THRESHOLD = 4    # Minimum score for a seed question to be kept by the seed filtering stage
+
+NUM_CORRECT_ANSWERS = 1  # Number of correct choices in each multiple choice question
 
 # --- File and Directory Path Configuration ---
 DATA_DIR = "data"
 SEED_FILE = os.path.join(DATA_DIR, "seed_questions.json")
+FILTERED_SEED_FILE = os.path.join(DATA_DIR, "0_filtered_seed_data.json")
 GENERATED_FILE = os.path.join(DATA_DIR, "1_generated_data.json")
 DEDUPLICATED_FILE = os.path.join(DATA_DIR, "2_deduplicated_data.json")
-QUALIFIED_FILE = os.path.join(DATA_DIR, "3_final_qualified_data.json")
\ No newline at end of file
+QUALIFIED_FILE = os.path.join(DATA_DIR, "3_final_qualified_data.json")
+JUDGEMENTS_FILE = os.path.join(DATA_DIR, "judgements.jsonl")  # Raw per-run verdicts of the filtering stages
+RETHRESHOLD_FILE = os.path.join(DATA_DIR, "3_rethreshold_qualified_data.json")  # Offline rethreshold output
+RETHRESHOLD_SEED_FILE = os.path.join(DATA_DIR, "0_rethreshold_seed_data.json")
+MULTIPLE_CHOICE_FILE = os.path.join(DATA_DIR, "5_multiple_choice_questions.json")
+TEST_RESULTS_FILE = os.path.join(DATA_DIR, "6_test_results.json")
+TEST_RESULTS_STORE = os.path.join(DATA_DIR, "test_responses.jsonl")  # Stored responses keyed by (model, question hash)
+LEADERBOARD_FILE = os.path.join(DATA_DIR, "leaderboard.md")
+MANIFEST_FILE = os.path.join(DATA_DIR, "pipeline_manifest.json")  # Per-seed input fingerprints of each stage
@@ -7,6 +7,55 @@ import config
 from src import stages, utils
 import asyncio
 import argparse
+import inspect
+
+# Stages selected by each --stage value of the dataset pipeline
+STAGE_TARGETS = {
+    'all': ['generate', 'deduplicate', 'filter'],
+    'generate': ['generate', 'deduplicate'],
+    'filter': ['filter'],
+    'combine': ['combine'],
+    'seed_filter': ['seed_filter'],
+}
+
+def build_pipeline_dag(manifest_file: str, full_rebuild: bool = False) -> dict:
+    """
+    Returns the stage DAG of the dataset pipeline: {stage name: (upstream stages, runner)}.
+
+    Generation and filtering fingerprint their per-seed inputs in manifest_file, so only seeds whose
+    inputs changed are recomputed and untouched packets are reused from the previous outputs.
+    With full_rebuild, the stages that run ignore their own manifest entries (other stages keep theirs).
+    """
+    return {
+        'seed_filter': ([], lambda: stages.run_seed_filtering_stage(
+            config.SEED_FILE, config.FILTERED_SEED_FILE)),
+        'generate': ([], lambda: stages.run_generation_stage(
+            config.SEED_FILE, config.GENERATED_FILE, manifest_file=manifest_file, full_rebuild=full_rebuild)),
+        'deduplicate': (['generate'], lambda: stages.run_deduplication_stage(
+            config.GENERATED_FILE, config.DEDUPLICATED_FILE)),
+        'filter': (['deduplicate'], lambda: stages.run_filtering_stage(
+            config.DEDUPLICATED_FILE, config.QUALIFIED_FILE, manifest_file=manifest_file, full_rebuild=full_rebuild)),
+        'combine': (['filter'], lambda: stages.run_combination_stage(
+            config.QUALIFIED_FILE, config.MULTIPLE_CHOICE_FILE)),
+    }
+
+def topological_order(dag: dict, selected: list) -> list:
+    """Orders the selected stages so that each runs after its selected upstream stages."""
+    ordered = []
+
+    def visit(name, path):
+        if name in ordered:
+            return
+        if name in path:
+            raise ValueError(f"Cycle in the stage DAG at: {name}")
+        for upstream in dag[name][0]:
+            if upstream in selected:
+                visit(upstream, path | {name})
+        ordered.append(name)
+
+    for name in selected:
+        visit(name, set())
+    return ordered
 
 def main():
     """Execute the entire pipeline."""
@@ -15,11 +64,31 @@ def main():
     parser.add_argument(
         '--stage', 
         type=str, 
-        choices=['all', 'generate', 'filter'], 
+        choices=['all', 'seed_filter', 'generate', 'filter', 'combine', 'rethreshold', 'test'], 
         default='all',
-        help="Run a specific stage: 'generate' (gen+dedup), 'filter', or 'all'."
+        help="Run a specific stage: 'seed_filter' (judge the seed questions), 'generate' (gen+dedup), 'filter', 'all', "
+             "'combine' (build the multiple choice questions from the qualified data), "
+             "'rethreshold' (re-apply thresholds to stored verdicts offline), "
+             "or 'test' (incremental leaderboard evaluation)."
     )
+    parser.add_argument('--target', choices=['filter', 'seed_filter'], default='filter',
+                        help="[rethreshold] Which filtering stage to re-apply.")
+    parser.add_argument('--score-min', type=int, default=None, help="[rethreshold] Minimum qualified score.")
+    parser.add_argument('--score-max', type=int, default=None, help="[rethreshold] Maximum qualified score.")
+    parser.add_argument('--models', type=str, default=None,
+                        help="[rethreshold] Comma-separated subset of filter models whose verdicts are counted.")
+    parser.add_argument('--full-rebuild', action='store_true',
+                        help="Ignore previous outputs and recompute every seed (pipeline stages) "
+                             "or every (model, question) pair (test).")
+    parser.add_argument('--output', type=str, default=None,
+                        help="[rethreshold] Output file for the qualified set (agreement statistics are "
+                             "written next to it as <output>_agreement.json).")
     args = parser.parse_args()
+    if args.stage == 'rethreshold' and args.models and (
+        args.score_min is None or (args.target == 'filter' and args.score_max is None)
+    ):
+        parser.error("--models changes the number of counted runs, so --score-min (and --score-max for "
+                     "--target filter) must be given explicitly.")
 
     # 1. Configure logging
     logging.basicConfig(
@@ -53,24 +122,49 @@ def main():
     #     )
         
     async def async_main():
-    # Selectively execute different stages based on command-line arguments
-    
-    # If the argument is 'all' or 'generate', execute the generation and deduplication stages
-    if args.stage in ['all', 'generate']:
-        await stages.run_generation_stage(config.SEED_FILE, config.GENERATED_FILE)
-        stages.run_deduplication_stage(config.GENERATED_FILE, config.DEDUPLICATED_FILE)
-    
-    # 如If the argument is 'all' or 'filter', execute the filtering stage
-    if args.stage in ['all', 'filter']:
-        await stages.run_filtering_stage(config.DEDUPLICATED_FILE, config.QUALIFIED_FILE)
-            
- 
+        # Selectively execute different stages based on command-line arguments
+
+        if args.stage in STAGE_TARGETS:
+            dag = build_pipeline_dag(config.MANIFEST_FILE, full_rebuild=args.full_rebuild)
+            for name in topological_order(dag, STAGE_TARGETS[args.stage]):
+                result = dag[name][1]()
+                if inspect.isawaitable(result):
+                    await result
+
+        # Only (model, question) pairs missing from the results store are queried
+        if args.stage == 'test':
+            await stages.run_test(
+                config.MULTIPLE_CHOICE_FILE, config.TEST_RESULTS_FILE,
+                results_store=config.TEST_RESULTS_STORE,
+                leaderboard_file=config.LEADERBOARD_FILE,
+                reuse_stored=not args.full_rebuild,
+            )
+
+    if args.stage == 'rethreshold':
+        # Offline: re-apply thresholds to the stored verdicts, no API calls
+        is_seed_target = args.target == 'seed_filter'
+        stages.run_rethreshold_stage(
+            source_file=config.SEED_FILE if is_seed_target else config.DEDUPLICATED_FILE,
+            output_file=args.output or (config.RETHRESHOLD_SEED_FILE if is_seed_target else config.RETHRESHOLD_FILE),
+            target=args.target,
+            judgements_file=config.JUDGEMENTS_FILE,
+            score_min=args.score_min,
+            score_max=args.score_max,
+            models=args.models.split(',') if args.models else None,
+        )
+        return
+
     # Run the main asynchronous function
     asyncio.run(async_main())
 
     logging.info("="*50)
     logging.info("Pipeline finished successfully!")
-    logging.info(f"Final qualified questions are saved in: {config.QUALIFIED_FILE}")
+    if args.stage == 'test':
+        logging.info(f"Leaderboard is saved in: {config.LEADERBOARD_FILE}")
+    elif args.stage == 'seed_filter':
+        logging.info(f"Filtered seed questions are saved in: {config.FILTERED_SEED_FILE}")
+    else:
+        logging.info(f"Final qualified questions are saved in: {config.QUALIFIED_FILE}")
     logging.info("="*50)
 
 if __name__ == "__main__":
@@ -1,19 +1,207 @@
 
 """Encapsulates the interaction logic with various large language models"""
 
+import asyncio
+import json
 import logging
+import math
+import threading
 import time
-from typing import List, Dict, Any
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from typing import List, Dict, Any, Optional, Tuple
 
 import openai
 import google.generativeai as genai
 import anthropic
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
+import config
 from config import API_CONFIG
 
 _CLIENT_CACHE = {}
 
+# In-flight requests by (model, messages, temperature, sample_slot), shared across worker threads
+_IN_FLIGHT: Dict[Tuple, Future] = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+# Same, for acall_llm callers on the event loop; registered before the request waits for a worker thread
+_ASYNC_IN_FLIGHT: Dict[Tuple, "asyncio.Task"] = {}
+
+MAX_ATTEMPTS = 6          # Total attempts for retryable errors
+MAX_RETRY_AFTER = 120.0   # Upper bound (seconds) on a server-requested Retry-After wait
+ANTHROPIC_MAX_TOKENS = 4096
+CHARS_PER_TOKEN = 3       # Conservative estimate for LaTeX-heavy mathematical text
+TRUNCATION_MARKER = "\n\n[... truncated to fit the model context window ...]"
+
+# --- Error taxonomy ---
+class LLMError(Exception):
+    """Base class for errors raised by call_llm."""
+    def __init__(self, message: str, model_name: str = ""):
+        super().__init__(message)
+        self.model_name = model_name
+
+class RetryableLLMError(LLMError):
+    """Errors that may succeed on retry. Honours a server-provided Retry-After if present."""
+    def __init__(self, message: str, model_name: str = "", retry_after: Optional[float] = None):
+        super().__init__(message, model_name)
+        self.retry_after = retry_after
+
+class RateLimitError(RetryableLLMError):
+    """HTTP 429: rate limit or quota throttling."""
+
+class TransientError(RetryableLLMError):
+    """Timeouts, connection failures, overloaded or 5xx responses."""
+
+class NonRetryableLLMError(LLMError):
+    """Errors that will fail again on retry and are raised immediately."""
+
+class AuthenticationError(NonRetryableLLMError):
+    """HTTP 401/403: invalid API key or missing permission."""
+
+class ModelNotFoundError(NonRetryableLLMError):
+    """HTTP 404: unknown model name or endpoint."""
+
+class ContentPolicyError(NonRetryableLLMError):
+    """The request was rejected by the provider's content policy."""
+
+class ContextLengthExceededError(NonRetryableLLMError):
+    """The prompt does not fit into the model's context window."""
+
+class InvalidRequestError(NonRetryableLLMError):
+    """Any other malformed request (HTTP 400/422)."""
+
+class UnexpectedLLMError(NonRetryableLLMError):
+    """Any other exception, e.g. a programming error or a malformed response."""
+
+_CONNECTION_ERRORS = (
+    openai.APIConnectionError, openai.APITimeoutError,
+    anthropic.APIConnectionError, anthropic.APITimeoutError,
+)
+# Provider error codes (OpenAI/Azure, Qwen DashScope)
+_CONTEXT_LENGTH_CODES = {"context_length_exceeded", "string_above_max_length"}
+_CONTENT_POLICY_CODES = {"content_policy_violation", "content_filter", "data_inspection_failed"}
+# Providers without a dedicated code (Anthropic, DeepSeek) only describe context overflows in the message
+_CONTEXT_LENGTH_MARKERS = (
+    "maximum context length", "prompt is too long", "input is too long", "range of input length",
+)
+
+def _error_codes(error: Exception) -> set:
+    """Collects the provider error codes/types of an SDK exception, from its attributes and response body."""
+    codes = {getattr(error, "code", None), getattr(error, "type", None)}
+    body = getattr(error, "body", None)
+    if isinstance(body, dict):
+        codes.update((body.get("code"), body.get("type")))
+        inner = body.get("error")
+        if isinstance(inner, dict):
+            codes.update((inner.get("code"), inner.get("type")))
+    return {str(code).lower() for code in codes if code}
+
+def _parse_retry_after(error: Exception) -> Optional[float]:
+    """Reads the Retry-After (or retry-after-ms) header of a failed HTTP response, in seconds."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _classify_error(model_name: str, error: Exception) -> LLMError:
+    """Maps an exception from the OpenAI-compatible or Anthropic SDK onto the error taxonomy."""
+    if isinstance(error, LLMError):
+        return error
+    message = f"{type(error).__name__}: {error}"
+    lowered = str(error).lower()
+    status = getattr(error, "status_code", None)
+
+    if isinstance(error, _CONNECTION_ERRORS):
+        return TransientError(message, model_name)
+    if status is None:
+        return UnexpectedLLMError(message, model_name)
+    if status == 429:
+        return RateLimitError(message, model_name, _parse_retry_after(error))
+    if status in (408, 409) or status >= 500:
+        return TransientError(message, model_name, _parse_retry_after(error))
+    if status in (401, 403):
+        return AuthenticationError(message, model_name)
+    if status == 404:
+        return ModelNotFoundError(message, model_name)
+    codes = _error_codes(error)
+    if status == 413 or codes & _CONTEXT_LENGTH_CODES or any(marker in lowered for marker in _CONTEXT_LENGTH_MARKERS):
+        return ContextLengthExceededError(message, model_name)
+    if codes & _CONTENT_POLICY_CODES:
+        return ContentPolicyError(message, model_name)
+    return InvalidRequestError(message, model_name)
+
+def _wait_retry_after_or_exponential(retry_state) -> float:
+    """Waits for the server-requested Retry-After if given, else a random exponential backoff."""
+    error = retry_state.outcome.exception()
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        return min(retry_after, MAX_RETRY_AFTER)
+    return wait_random_exponential(min=1, max=60)(retry_state)
+
+# --- Pre-flight context-length check ---
+def estimate_tokens(text: str) -> int:
+    """Roughly estimates the number of tokens of a text without a tokenizer."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def get_context_limit(model_name: str) -> int:
+    """Returns the context window of a model, using the longest matching key in MODEL_CONTEXT_LIMITS."""
+    matches = [key for key in config.MODEL_CONTEXT_LIMITS if key in model_name]
+    if not matches:
+        return config.DEFAULT_CONTEXT_LIMIT
+    return config.MODEL_CONTEXT_LIMITS[max(matches, key=len)]
+
+def get_context_budget(model_name: str) -> int:
+    """Returns the number of prompt tokens a request to the model may use, leaving room for the response."""
+    return get_context_limit(model_name) - config.RESPONSE_TOKEN_RESERVE
+
+def fits_context(model_name: str, messages: List[Dict[str, str]]) -> bool:
+    """Checks, without truncation and without sending anything, whether the messages fit the model's context."""
+    return sum(estimate_tokens(m.get('content', '')) for m in messages) <= get_context_budget(model_name)
+
+def _preflight_context_check(model_name: str, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Checks that the messages fit the model's context window, leaving room for the response.
+
+    Oversized requests are rejected with ContextLengthExceededError, or, if CONTEXT_OVERFLOW_POLICY is
+    'truncate', the longest user message (the payload) is cut from the end until the request fits.
+    System messages, which carry the instructions and output format, are never truncated.
+    """
+    budget = get_context_budget(model_name)
+    used = sum(estimate_tokens(m.get('content', '')) for m in messages)
+    if used <= budget:
+        return messages
+
+    user_indices = [i for i, m in enumerate(messages) if m.get('role') == 'user']
+    if config.CONTEXT_OVERFLOW_POLICY != "truncate" or not user_indices:
+        raise ContextLengthExceededError(
+            f"Estimated {used} prompt tokens exceed the budget of {budget} tokens for {model_name}.", model_name
+        )
+
+    longest = max(user_indices, key=lambda i: len(messages[i].get('content', '')))
+    content = messages[longest]['content']
+    keep_chars = len(content) - (used - budget) * CHARS_PER_TOKEN - len(TRUNCATION_MARKER)
+    if keep_chars <= 0:
+        raise ContextLengthExceededError(
+            f"Cannot truncate the request for {model_name} to fit {budget} tokens.", model_name
+        )
+    logging.warning(f"Truncating the user message for {model_name} from {len(content)} to {keep_chars} characters "
+                    f"(estimated {used} tokens > budget {budget}).")
+    truncated = list(messages)
+    truncated[longest] = {**messages[longest], 'content': content[:keep_chars] + TRUNCATION_MARKER}
+    return truncated
+
 def _get_client(model_name: str):
     """Initializes clients on demand and caches them to avoid repeated initialization"""
     global _CLIENT_CACHE
@@ -37,23 +225,92 @@ def _get_client(model_name: str):
     _CLIENT_CACHE[model_name] = client
     return client
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def call_llm(model_name: str, messages: List[Dict[str, str]], temperature: float = 0.5) -> str:
+def call_llm(
+    model_name: str, messages: List[Dict[str, str]], temperature: float = 0.5, sample_slot: Optional[int] = None
+) -> str:
     """
     Calls the corresponding API based on the model name and implements automatic retries.
 
+    Concurrent calls with an identical (model, messages, temperature, sample_slot) key are coalesced:
+    the first caller sends the request and every other caller waits for and shares its result (or error).
+    Calls that deliberately sample the same prompt several times must pass distinct sample_slot values.
+    The pipeline stages call it through acall_llm, which coalesces identical calls while they are still queued.
+
+    Only RetryableLLMError (rate limits, timeouts, 5xx) is retried, honouring Retry-After headers;
+    NonRetryableLLMError (authentication, unknown model, content policy, context length) fails immediately.
+
     Args:
         model_name: The name of the model to call.
         messages: A list of messages in OpenAI format.
         temperature: The temperature parameter for generation.
+        sample_slot: Distinguishes intentionally repeated samples of the same prompt.
 
     Returns:
         The text response from the model.
     
     Raises:
         ValueError: If the model provider is unknown.
-        Exception: If the API call fails.
+        ContextLengthExceededError: If the request does not fit the model's context window.
+        LLMError: If the API call fails, classified as retryable or non-retryable.
     """
+    key = _request_key(model_name, messages, temperature, sample_slot)
+    with _IN_FLIGHT_LOCK:
+        future = _IN_FLIGHT.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _IN_FLIGHT[key] = future
+
+    if not is_leader:
+        logging.info(f"Joining an identical in-flight request to {model_name}...")
+        return future.result()
+
+    try:
+        result = _call_llm_with_retries(model_name, messages, temperature)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _IN_FLIGHT_LOCK:
+            _IN_FLIGHT.pop(key, None)
+
+async def acall_llm(
+    model_name: str, messages: List[Dict[str, str]], temperature: float = 0.5, sample_slot: Optional[int] = None
+) -> str:
+    """
+    Runs call_llm in a worker thread without blocking the event loop.
+
+    Identical calls are coalesced as soon as they are scheduled, not only once a worker thread picks them up:
+    with more concurrent calls than threads, a duplicate queued behind the thread pool would otherwise start
+    after the first call had already finished. Cancelling one caller does not cancel the shared request.
+    """
+    key = _request_key(model_name, messages, temperature, sample_slot)
+    task = _ASYNC_IN_FLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(call_llm, model_name, messages, temperature, sample_slot))
+        _ASYNC_IN_FLIGHT[key] = task
+        task.add_done_callback(lambda _: _ASYNC_IN_FLIGHT.pop(key, None))
+    else:
+        logging.info(f"Joining an identical in-flight request to {model_name}...")
+    return await asyncio.shield(task)
+
+def _request_key(
+    model_name: str, messages: List[Dict[str, str]], temperature: float, sample_slot: Optional[int]
+) -> Tuple:
+    return (model_name, json.dumps(messages, sort_keys=True, ensure_ascii=False), temperature, sample_slot)
+
+@retry(
+    retry=retry_if_exception_type(RetryableLLMError),
+    wait=_wait_retry_after_or_exponential,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    reraise=True,
+)
+def _call_llm_with_retries(model_name: str, messages: List[Dict[str, str]], temperature: float) -> str:
+    """Sends one request to the model, retrying retryable errors. See call_llm."""
+    messages = _preflight_context_check(model_name, messages)
     logging.info(f"Calling model: {model_name}...")
     start_time = time.time()
     
@@ -73,7 +330,7 @@ def call_llm(model_name: str, messages: List[Dict[str, str]], temperature: float
             system_prompt = messages[0].get('content', '') if messages and messages[0]['role'] == 'system' else ""
             user_messages = messages[1:] if system_prompt else messages
             response = client.messages.create(
-                model=model_name, max_tokens=4096, system=system_prompt, messages=user_messages, temperature=temperature
+                model=model_name, max_tokens=ANTHROPIC_MAX_TOKENS, system=system_prompt, messages=user_messages, temperature=temperature
             )
             response_text = response.content[0].text
 
@@ -82,9 +339,18 @@ def call_llm(model_name: str, messages: List[Dict[str, str]], temperature: float
     except KeyError as e:
         logging.error(f"Missing API configuration for model: {model_name}. Error: {e}", exc_info=True)
         raise ValueError(f"Missing required API config for model: {model_name}") from e      
+    except ValueError:
+        raise  # Configuration errors are never retried
     except Exception as e:
-        logging.error(f"API call to {model_name} failed. Error: {e}", exc_info=True)
-        raise
+        error = _classify_error(model_name, e)
+        if isinstance(error, RetryableLLMError):
+            wait_hint = f" (Retry-After: {error.retry_after:.1f}s)" if error.retry_after is not None else ""
+            logging.warning(f"API call to {model_name} failed with retryable {type(error).__name__}{wait_hint}: {e}")
+        else:
+            logging.error(f"API call to {model_name} failed with non-retryable {type(error).__name__}: {e}")
+        if error is e:
+            raise
+        raise error from e
 
     duration = time.time() - start_time
     logging.info(f"Response from {model_name} received in {duration:.2f}s.")
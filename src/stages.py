@@ -2,8 +2,9 @@
 """Contains the core stages of the pipeline: data generation and quality filtering."""
 import json
 import logging
+import os
 import random
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import asyncio
 import re
 
@@ -11,7 +12,109 @@ import re
 import config
 from src import prompts, llm_api, utils
 
-async def run_seed_filtering_stage(seed_file: str, output_file: str) -> None:
+async def _judge_one_run(
+    model_name: str, run_index: int, prompt: str, item_type: str, judge_temperature: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Runs one judgement of a filter model, falling back to the Judge Model if no verdict can be parsed.
+
+    Returns the raw verdict record: model, run index, parsed result, whether the judge fallback was used
+    and the hashes of the raw responses.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    try:
+        # Each run is a deliberate repeat sample, so the run index keeps it from being coalesced with the others
+        response_text = await llm_api.acall_llm(model_name, messages, sample_slot=run_index)
+    except (llm_api.ContextLengthExceededError, llm_api.ContentPolicyError) as e:
+        logging.error(f"  ! {model_name} cannot judge this item ({type(e).__name__}). The item is unjudgeable.")
+        return {
+            "model": model_name, "run_index": run_index, "model_result": "Error", "judge_fallback": False,
+            "response_hash": None, "error": type(e).__name__, "eval_result": "Error",
+        }
+    eval_result = utils.parse_eval_result(response_text)
+    verdict = {
+        "model": model_name,
+        "run_index": run_index,
+        "model_result": eval_result,
+        "judge_fallback": False,
+        "response_hash": utils.hash_text(response_text),
+    }
+
+    if eval_result == "Error":  # Fallback to Judge Model
+        logging.warning(f"  ! No valid \\boxed{{}} found. Using Judge Model ({config.JUDGE_MODEL})...")
+
+        if item_type == 'proposition-proof':
+            judge_prompt = prompts.MODEL_JUDGE_PROOF_PROMPT + response_text
+        elif item_type == 'definition':
+            judge_prompt = prompts.MODEL_JUDGE_DEFINITION_PROMPT + response_text
+        else:
+            raise ValueError(f"Unknown item type: {item_type}")
+
+        judge_messages = [{"role": "user", "content": judge_prompt}]
+        judge_kwargs = {} if judge_temperature is None else {"temperature": judge_temperature}
+        judge_response = ""
+        if not llm_api.fits_context(config.JUDGE_MODEL, judge_messages):
+            # Never let the judge see a truncated response
+            logging.error(f"  ! Response is too long for the Judge Model ({config.JUDGE_MODEL}).")
+            verdict["error"] = llm_api.ContextLengthExceededError.__name__
+        else:
+            try:
+                judge_response = await llm_api.acall_llm(config.JUDGE_MODEL, judge_messages, **judge_kwargs)
+            except (llm_api.ContextLengthExceededError, llm_api.ContentPolicyError) as e:
+                logging.error(f"  ! Judge Model cannot evaluate this response ({type(e).__name__}).")
+                verdict["error"] = type(e).__name__
+        eval_result = utils.parse_eval_result(judge_response)
+        logging.info(f"  + Judge Model decision: {eval_result}")
+        if eval_result == "Error":
+            logging.error(f"  ! Judge Model also failed to evaluate. Discarding item.")
+        verdict["judge_fallback"] = True
+        verdict["judge_model"] = config.JUDGE_MODEL
+        verdict["judge_response_hash"] = utils.hash_text(judge_response)
+
+    verdict["eval_result"] = eval_result
+    return verdict
+
+def _verdict_score(verdict: Dict[str, Any]) -> int:
+    """A judgement scores 1 when the item was judged incorrect."""
+    return 1 if verdict["eval_result"] == 'F' else 0
+
+def _item_score(verdicts: Optional[List[Dict[str, Any]]]) -> Optional[int]:
+    """
+    Sums the verdict scores of one item. Returns None if the item is unjudgeable, i.e. it was rejected before
+    any call (verdicts is None) or a call was rejected for its context length or content policy: such a run
+    is not a "T" vote and must not lower the score.
+    """
+    if verdicts is None or any(v.get("error") for v in verdicts):
+        return None
+    return sum(_verdict_score(v) for v in verdicts)
+
+def _models_rejecting_prompt(prompt: str) -> List[str]:
+    """
+    Returns the filter models whose context window cannot hold the evaluation prompt. Checked before any
+    judging call is sent, so no run is paid for an item that some model cannot judge. The judging stages
+    never truncate: a stored verdict must describe the content the model actually saw.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    return [model for model in config.FILTER_MODELS if not llm_api.fits_context(model, messages)]
+
+def _store_judgements(
+    judgements_file: Optional[str], stage: str, seed_id: str, item_id: str,
+    content: Dict[str, Any], ground_truth: str, verdicts: List[Dict[str, Any]]
+) -> None:
+    """Persists every raw verdict of one item so thresholds can later be re-applied offline."""
+    if not judgements_file:
+        return
+    item_hash = utils.hash_content(content)
+    records = [
+        {"stage": stage, "seed_id": seed_id, "item_id": item_id, "item_hash": item_hash,
+         "ground_truth": ground_truth, **verdict}
+        for verdict in verdicts
+    ]
+    utils.append_to_jsonl(records, judgements_file)
+
+async def run_seed_filtering_stage(
+    seed_file: str, output_file: str, judgements_file: Optional[str] = config.JUDGEMENTS_FILE
+) -> None:
     """
     Executes stage zero: Filter seed questions.
     """
@@ -28,40 +131,22 @@ async def run_seed_filtering_stage(seed_file: str, output_file: str) -> None:
         content = seed['content']
 
         prompt = utils.format_eval_prompt(item_type, content)
-
-        async def judge_one_run(model_name: str) -> int:
-            messages = [{"role": "user", "content": prompt}]
-            response_text = await asyncio.to_thread(llm_api.call_llm, model_name, messages)
-            eval_result = utils.parse_eval_result(response_text)
-
-            if eval_result == "Error":  # Fallback to Judge Model
-                logging.warning(f"  ! No valid \\boxed{{}} found. Using Judge Model ({config.JUDGE_MODEL})...")
-
-                if item_type == 'proposition-proof':
-                    judge_prompt = prompts.MODEL_JUDGE_PROOF_PROMPT + response_text
-                elif item_type == 'definition':
-                    judge_prompt = prompts.MODEL_JUDGE_DEFINITION_PROMPT + response_text
-                else:
-                    raise ValueError(f"Unknown item type: {item_type}")
-
-                judge_messages = [{"role": "user", "content": judge_prompt}]
-                judge_response = await asyncio.to_thread(
-                    llm_api.call_llm, config.JUDGE_MODEL, judge_messages
-                )
-                eval_result = utils.parse_eval_result(judge_response)
-                logging.info(f"  + Judge Model decision: {eval_result}")
-                if eval_result == "Error":
-                    logging.error(f"  ! Judge Model also failed to evaluate. Discarding item.")
-
-            return 1 if eval_result == 'F' else 0
+        rejecting_models = _models_rejecting_prompt(prompt)
+        if rejecting_models:
+            logging.info(f"  -- Seed ID: {seed['id']} does not fit the context of {', '.join(rejecting_models)}, discarding it.")
+            return None
 
         tasks = [
-            judge_one_run(model)
+            _judge_one_run(model, run_index, prompt, item_type)
             for model in config.FILTER_MODELS
-            for _ in range(config.JUDGEMENT_RUNS_PER_MODEL)
+            for run_index in range(config.JUDGEMENT_RUNS_PER_MODEL)
         ]
-        judgement_scores = await asyncio.gather(*tasks)
-        total_score = sum(judgement_scores)
+        verdicts = await asyncio.gather(*tasks)
+        _store_judgements(judgements_file, "seed_filter", seed['id'], seed['id'], content, "Correct", verdicts)
+        total_score = _item_score(verdicts)
+        if total_score is None:
+            logging.info(f"  -- Seed ID: {seed['id']} is UNJUDGEABLE by some filter model, discarding it.")
+            return None
 
         logging.info(f"  -- Seed ID: {seed['id']} total score: {total_score}")
         if total_score >= config.SEED_QUALITY_THRESHOLD:
@@ -80,9 +165,90 @@ async def run_seed_filtering_stage(seed_file: str, output_file: str) -> None:
     utils.save_to_json(qualified_seeds, output_file)
     logging.info(f"Filtering complete, kept {len(qualified_seeds)} high-quality seed questions in total.")
 
-async def run_generation_stage(seed_file: str, output_file: str) -> None:
+def _load_manifest(manifest_file: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    """Loads the stage manifest ({stage: {seed_id: entry}}), or an empty one."""
+    if not manifest_file or not os.path.exists(manifest_file):
+        return {}
+    return utils.load_from_json(manifest_file) or {}
+
+def _save_stage_manifest(manifest_file: Optional[str], stage: str, entries: Dict[str, Dict[str, Any]]) -> None:
+    """Replaces the entries of one stage in the manifest, leaving the other stages untouched."""
+    if not manifest_file:
+        return
+    manifest = _load_manifest(manifest_file)
+    manifest[stage] = entries
+    utils.save_to_json(manifest, manifest_file)
+
+def generation_fingerprint(seed: Dict[str, Any]) -> str:
+    """Fingerprints every input of the generation stage for one seed."""
+    gen_prompt = prompts.PROOF_GEN_PROMPT if seed['type'] == 'proposition-proof' else prompts.DEFINITION_GEN_PROMPT
+    return utils.hash_content({
+        "seed": {"id": seed['id'], "type": seed['type'], "content": seed['content']},
+        "prompt": gen_prompt,
+        "models": config.GENERATOR_MODELS,
+        "num_to_sample": config.NUM_TO_SAMPLE,
+    })
+
+def filtering_fingerprint(packet: Dict[str, Any]) -> str:
+    """
+    Fingerprints the inputs of the judging calls for one deduplicated packet.
+
+    The qualification thresholds are deliberately left out: they are applied to the stored verdicts,
+    so changing them never requires judging again.
+    """
+    return utils.hash_content({
+        "packet": packet,
+        "prompts": [prompts.DEFINITION_EVAL_PROMPT, prompts.PROOF_EVAL_PROMPT,
+                    prompts.MODEL_JUDGE_DEFINITION_PROMPT, prompts.MODEL_JUDGE_PROOF_PROMPT],
+        "models": config.FILTER_MODELS,
+        "judge_model": config.JUDGE_MODEL,
+        "runs_per_model": config.JUDGEMENT_RUNS_PER_MODEL,
+        # Pre-flight rejections are cached, so they must be recomputed when a context budget changes
+        "context_budgets": {model: llm_api.get_context_budget(model) for model in config.FILTER_MODELS + [config.JUDGE_MODEL]},
+    })
+
+def _stored_item_verdicts(
+    verdicts_by_item: Dict[tuple, List[Dict[str, Any]]], item: Dict[str, Any]
+) -> Optional[List[Dict[str, Any]]]:
+    """Returns the stored verdicts of an item if every (filter model, run) slot is present and judgeable, else None."""
+    expected_slots = {
+        (model, run_index)
+        for model in config.FILTER_MODELS
+        for run_index in range(config.JUDGEMENT_RUNS_PER_MODEL)
+    }
+    stored = verdicts_by_item.get((item['id'], utils.hash_content(item['content'])), [])
+    verdicts = [v for v in stored if (v["model"], v["run_index"]) in expected_slots]
+    if {(v["model"], v["run_index"]) for v in verdicts} != expected_slots or _item_score(verdicts) is None:
+        return None
+    return verdicts
+
+def _qualified_packet(
+    packet: Dict[str, Any], item_scores: Dict[str, Optional[int]], score_min: int, score_max: Optional[int]
+) -> Optional[Dict[str, Any]]:
+    """Applies the score thresholds to the items of one packet. Returns the final packet, or None if nothing passed."""
+    surviving_incorrect_texts = []
+    for item in packet['generated_incorrect']:
+        score = item_scores.get(item['id'])
+        if score is not None and score >= score_min and (score_max is None or score <= score_max):
+            surviving_incorrect_texts.append({**item, "filter_score": score})
+    if not surviving_incorrect_texts:
+        return None
+    return {
+        "seed_id": packet['seed_id'], "type": packet['type'],
+        "original_correct_text": packet['original_correct'],
+        "qualified_incorrect_texts": surviving_incorrect_texts
+    }
+
+async def run_generation_stage(
+    seed_file: str, output_file: str, manifest_file: Optional[str] = None, full_rebuild: bool = False
+) -> None:
     """
     Executes stage one: Generate data containing incorrect proofs/definitions from the seed file.
+
+    If manifest_file is given, seeds whose fingerprint (content, prompt, models, parameters) is unchanged
+    since the last run reuse their packet from the previous output_file instead of being regenerated.
+    full_rebuild ignores the manifest entries of this stage. The output and manifest are saved even if
+    the stage is interrupted, so finished seeds are not paid for again.
     """
     logging.info("="*20 + " STAGE 1: DATA GENERATION " + "="*20)
     seed_questions = utils.load_from_json(seed_file)
@@ -90,48 +256,84 @@ async def run_generation_stage(seed_file: str, output_file: str) -> None:
         logging.error("No seed questions found. Aborting generation stage.")
         return
 
-    all_generated_data = []
-    for seed in seed_questions:
-        logging.info(f"--- Processing Seed ID: {seed['id']} ---")
-        question_packet = {
-            "seed_id": seed['id'], "type": seed['type'],
-            "original_correct": {"id": f"{seed['id']}_original", "content": seed['content'], "ground_truth": "Correct"},
-            "generated_incorrect": []
-        }
+    stage_manifest = {} if full_rebuild else _load_manifest(manifest_file).get("generate", {})
+    previous_packets = {}
+    if manifest_file and stage_manifest and os.path.exists(output_file):
+        previous_packets = {packet['seed_id']: packet for packet in utils.load_from_json(output_file) or []}
 
-        generated_items_from_all_models = []
+    def reusable_packet(seed_id: str, fingerprint: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # The previous packet must be the one recorded in the manifest, not a hand-edited or foreign one
+        entry, packet = stage_manifest.get(seed_id), previous_packets.get(seed_id)
+        if not entry or packet is None or utils.hash_content(packet) != entry.get("packet_hash"):
+            return None
+        if fingerprint is not None and entry.get("fingerprint") != fingerprint:
+            return None
+        return packet
+
+    new_manifest = {}
+    generated_by_seed = {}
+    try:
+        for seed in seed_questions:
+            fingerprint = generation_fingerprint(seed)
+            previous_packet = reusable_packet(seed['id'], fingerprint)
+            if previous_packet is not None:
+                logging.info(f"--- Seed ID: {seed['id']} unchanged, reusing previous packet ---")
+                generated_by_seed[seed['id']] = previous_packet
+                new_manifest[seed['id']] = {"fingerprint": fingerprint, "packet_hash": utils.hash_content(previous_packet)}
+                continue
+
+            logging.info(f"--- Processing Seed ID: {seed['id']} ---")
+            question_packet = {
+                "seed_id": seed['id'], "type": seed['type'],
+                "original_correct": {"id": f"{seed['id']}_original", "content": seed['content'], "ground_truth": "Correct"},
+                "generated_incorrect": []
+            }
+
+            generated_items_from_all_models = []
         
-        async def get_items(model_name):
-            system_prompt = prompts.PROOF_GEN_PROMPT if seed['type'] == 'proposition-proof' else prompts.DEFINITION_GEN_PROMPT
-            if seed['type'] == 'proposition-proof':
-                user_content = f"Here's the proposition:\n\n{seed['content']['proposition']}\n\n\nHere's the proof:\n\n{seed['content']['proof']}"
-            else:
-                user_content = f"Here's the definition:\n\n{seed['content']['text']}"
-            messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}]
-            response_text = await asyncio.to_thread(llm_api.call_llm, model_name, messages)
-            items = [item.strip() for item in utils.parse_generated_items(response_text)]
-            print(f"  - Model {model_name} generated {len(items)} items.")
-            sampled_items = random.sample(items, 2) if len(items) >= 2 else items
-            return sampled_items
-
-        tasks = []
+            async def get_items(model_name):
+                system_prompt = prompts.PROOF_GEN_PROMPT if seed['type'] == 'proposition-proof' else prompts.DEFINITION_GEN_PROMPT
+                if seed['type'] == 'proposition-proof':
+                    user_content = f"Here's the proposition:\n\n{seed['content']['proposition']}\n\n\nHere's the proof:\n\n{seed['content']['proof']}"
+                else:
+                    user_content = f"Here's the definition:\n\n{seed['content']['text']}"
+                messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}]
+                try:
+                    response_text = await llm_api.acall_llm(model_name, messages)
+                except (llm_api.ContextLengthExceededError, llm_api.ContentPolicyError) as e:
+                    logging.error(f"  ! Model {model_name} skipped for seed {seed['id']} ({type(e).__name__}).")
+                    return []
+                items = [item.strip() for item in utils.parse_generated_items(response_text)]
+                print(f"  - Model {model_name} generated {len(items)} items.")
+                sampled_items = random.sample(items, config.NUM_TO_SAMPLE) if len(items) >= config.NUM_TO_SAMPLE else items
+                return sampled_items
+
+            tasks = []
         
-        async with asyncio.TaskGroup() as tg:
-            for model_name in config.GENERATOR_MODELS:
-                tasks.append(tg.create_task(get_items(model_name)))
-        for task in tasks:
-            generated_items_from_all_models.extend(await task)
-
-        for i, item_content in enumerate(generated_items_from_all_models):
-            content = {"proposition": seed['content']['proposition'], "proof": item_content} if seed['type'] == 'proposition-proof' else {"text": item_content}
-            question_packet["generated_incorrect"].append({"id": f"{seed['id']}_gen_{i}", "content": content, "ground_truth": "Wrong", "generating_model": config.GENERATOR_MODELS[i % len(config.GENERATOR_MODELS)]})
+            async with asyncio.TaskGroup() as tg:
+                for model_name in config.GENERATOR_MODELS:
+                    tasks.append(tg.create_task(get_items(model_name)))
+            for task in tasks:
+                generated_items_from_all_models.extend(await task)
+
+            for i, item_content in enumerate(generated_items_from_all_models):
+                content = {"proposition": seed['content']['proposition'], "proof": item_content} if seed['type'] == 'proposition-proof' else {"text": item_content}
+                question_packet["generated_incorrect"].append({"id": f"{seed['id']}_gen_{i}", "content": content, "ground_truth": "Wrong", "generating_model": config.GENERATOR_MODELS[i % len(config.GENERATOR_MODELS)]})
         
-        all_generated_data.append(question_packet)
-
-    utils.save_to_json(all_generated_data, output_file)
+            generated_by_seed[seed['id']] = question_packet
+            new_manifest[seed['id']] = {"fingerprint": fingerprint, "packet_hash": utils.hash_content(question_packet)}
+    finally:
+        # Keep the previous results of seeds not reached yet, so an interrupted refresh loses nothing
+        for seed in seed_questions:
+            if seed['id'] not in generated_by_seed and reusable_packet(seed['id']) is not None:
+                generated_by_seed[seed['id']] = previous_packets[seed['id']]
+                new_manifest[seed['id']] = stage_manifest[seed['id']]
+        all_generated_data = [generated_by_seed[seed['id']] for seed in seed_questions if seed['id'] in generated_by_seed]
+        utils.save_to_json(all_generated_data, output_file)
+        _save_stage_manifest(manifest_file, "generate", new_manifest)
 
 def run_deduplication_stage(generated_file: str, output_file: str):
-    """Stage two: Data deduplication."""
+    """Stage two: Data deduplication. Cheap and deterministic, so it is always recomputed in full."""
     logging.info("\n" + "="*20 + " STAGE 2: DEDUPLICATION " + "="*20)
     all_generated_data = utils.load_from_json(generated_file)
     if not all_generated_data:
@@ -161,74 +363,275 @@ def run_deduplication_stage(generated_file: str, output_file: str):
 
     utils.save_to_json(deduplicated_data, output_file)
 
-async def run_filtering_stage(deduplicated_file: str, output_file: str):
-    """Stage three: Quality filtering (using new logic)."""
+async def run_filtering_stage(
+    deduplicated_file: str,
+    output_file: str,
+    judgements_file: Optional[str] = config.JUDGEMENTS_FILE,
+    manifest_file: Optional[str] = None,
+    full_rebuild: bool = False,
+):
+    """
+    Stage three: Quality filtering (using new logic).
+
+    If manifest_file is given, packets whose fingerprint (content, prompts, models, judge model, runs) is
+    unchanged since the last run are not judged again: their verdicts are read back from judgements_file and
+    the current thresholds are re-applied. full_rebuild ignores the manifest entries of this stage.
+    The output and manifest are saved even if the stage is interrupted.
+    """
     logging.info("\n" + "="*20 + " STAGE 3: QUALITY FILTERING " + "="*20)
     all_deduplicated_data = utils.load_from_json(deduplicated_file)
     if not all_deduplicated_data:
         return
 
-    final_qualified_packets = []
-    for packet in all_deduplicated_data:
-        logging.info(f"\n--- Filtering Packet for Seed ID: {packet['seed_id']} ---")
-        surviving_incorrect_texts = []
-
-        async def filter_one_item(item_to_filter):
-            content = item_to_filter['content']
-            item_type = packet['type']
-            prompt = utils.format_eval_prompt(item_type, content)
-
-            async def judge_one_run(model_name: str) -> int:
-                messages = [{"role": "user", "content": prompt}]
-                response_text = await asyncio.to_thread(llm_api.call_llm, model_name, messages)
-                eval_result = utils.parse_eval_result(response_text)
-
-                if eval_result == "Error": # Fallback to Judge Model
-                    logging.warning(f"  ! No valid \\boxed{{}} found. Using Judge Model ({config.JUDGE_MODEL})...")
-
-                    if item_type == 'proposition-proof':
-                        judge_prompt = prompts.MODEL_JUDGE_PROOF_PROMPT + response_text
-                    elif item_type == 'definition':
-                        judge_prompt = prompts.MODEL_JUDGE_DEFINITION_PROMPT + response_text
-                    else:
-                        raise ValueError(f"Unknown item type: {item_type}")
-                    judge_messages = [{"role": "user", "content": judge_prompt}]
-                    judge_response = await asyncio.to_thread(llm_api.call_llm, config.JUDGE_MODEL, judge_messages, temperature=0.0)
-                    eval_result = utils.parse_eval_result(judge_response)
-                    logging.info(f"  + Judge Model decision: {eval_result}")
-                    if eval_result == "Error":
-                        logging.error(f"  ! Judge Model also failed to evaluate. Discarding item.")
-
-                return 1 if eval_result == 'F' else 0
-
-            tasks = [judge_one_run(model) for model in config.FILTER_MODELS for _ in range(config.JUDGEMENT_RUNS_PER_MODEL)]
-            judgement_scores = await asyncio.gather(*tasks)
-            total_score = sum(judgement_scores)
-
-            logging.info(f"  -- Filtering incorrect text (from {item_to_filter['generating_model']})... Score: {total_score}")
-            if config.QUALIFIED_SCORE_MIN <= total_score <= config.QUALIFIED_SCORE_MAX:
-                logging.info(f"     -> QUALIFIED!")
-                item_to_filter['filter_score'] = total_score
-                return item_to_filter
-            else:
-                logging.info(f"     -> DISCARDED.")
+    stage_manifest = {} if full_rebuild else _load_manifest(manifest_file).get("filter", {})
+    stored_verdicts = {}
+    if manifest_file and judgements_file and stage_manifest:
+        stored_verdicts = _load_judgements(judgements_file, "filter", config.FILTER_MODELS)
+
+    def reusable_verdicts(packet: Dict[str, Any], fingerprint: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        # Reusable only if the judging inputs are unchanged and every judgeable item still has all its stored
+        # verdicts. Items recorded as unjudgeable (a deterministic rejection) map to None.
+        entry = stage_manifest.get(packet['seed_id'])
+        if not entry or (fingerprint is not None and entry.get("fingerprint") != fingerprint):
+            return None
+        unjudgeable = set(entry.get("unjudgeable", []))
+        verdicts_by_item = {}
+        for item in packet['generated_incorrect']:
+            if item['id'] in unjudgeable:
+                verdicts_by_item[item['id']] = None
+                continue
+            verdicts = _stored_item_verdicts(stored_verdicts, item)
+            if verdicts is None:
                 return None
+            verdicts_by_item[item['id']] = verdicts
+        return verdicts_by_item
 
-        filter_results = await asyncio.gather(*(filter_one_item(item) for item in packet['generated_incorrect']))
-        surviving_incorrect_texts = [res for res in filter_results if res is not None]
+    new_manifest = {}
+    final_packets = {}
 
-        if surviving_incorrect_texts:
-            logging.info(f"  => Seed ID {packet['seed_id']} is KEPT with {len(surviving_incorrect_texts)} texts.")
-            final_packet = {
-                "seed_id": packet['seed_id'], "type": packet['type'],
-                "original_correct_text": packet['original_correct'],
-                "qualified_incorrect_texts": surviving_incorrect_texts
-            }
-            final_qualified_packets.append(final_packet)
+    async def filter_packet(packet: Dict[str, Any]) -> None:
+        fingerprint = filtering_fingerprint(packet)
+        verdicts_by_item = reusable_verdicts(packet, fingerprint)
+        if verdicts_by_item is not None:
+            logging.info(f"\n--- Packet for Seed ID: {packet['seed_id']} unchanged, reusing stored verdicts ---")
+        else:
+            logging.info(f"\n--- Filtering Packet for Seed ID: {packet['seed_id']} ---")
+
+            async def judge_one_item(item_to_filter):
+                content = item_to_filter['content']
+                item_type = packet['type']
+                prompt = utils.format_eval_prompt(item_type, content)
+                rejecting_models = _models_rejecting_prompt(prompt)
+                if rejecting_models:
+                    logging.warning(f"  ! Item {item_to_filter['id']} does not fit the context of "
+                                    f"{', '.join(rejecting_models)}, skipping it without any call.")
+                    return None
+
+                tasks = [
+                    _judge_one_run(model, run_index, prompt, item_type, judge_temperature=0.0)
+                    for model in config.FILTER_MODELS
+                    for run_index in range(config.JUDGEMENT_RUNS_PER_MODEL)
+                ]
+                verdicts = await asyncio.gather(*tasks)
+                _store_judgements(
+                    judgements_file, "filter", packet['seed_id'], item_to_filter['id'], content,
+                    item_to_filter.get('ground_truth', "Wrong"), verdicts
+                )
+                return verdicts
+
+            all_verdicts = await asyncio.gather(*(judge_one_item(item) for item in packet['generated_incorrect']))
+            verdicts_by_item = {item['id']: verdicts for item, verdicts in zip(packet['generated_incorrect'], all_verdicts)}
+
+        item_scores = {}
+        for item in packet['generated_incorrect']:
+            total_score = _item_score(verdicts_by_item[item['id']])
+            item_scores[item['id']] = total_score
+            if total_score is None:
+                logging.info(f"  -- Incorrect text (from {item['generating_model']}) is UNJUDGEABLE -> DISCARDED.")
+                continue
+            verdict_str = "QUALIFIED!" if config.QUALIFIED_SCORE_MIN <= total_score <= config.QUALIFIED_SCORE_MAX else "DISCARDED."
+            logging.info(f"  -- Filtering incorrect text (from {item['generating_model']})... Score: {total_score} -> {verdict_str}")
+
+        final_packet = _qualified_packet(packet, item_scores, config.QUALIFIED_SCORE_MIN, config.QUALIFIED_SCORE_MAX)
+        if final_packet:
+            logging.info(f"  => Seed ID {packet['seed_id']} is KEPT with {len(final_packet['qualified_incorrect_texts'])} texts.")
         else:
             logging.info(f"  => Seed ID {packet['seed_id']} is DISCARDED as no texts passed filtering.")
+        # Rejections are deterministic for a fingerprint, so they are cached too; transient failures
+        # raise instead and leave the packet out of the manifest
+        new_manifest[packet['seed_id']] = {
+            "fingerprint": fingerprint,
+            "unjudgeable": [item_id for item_id, score in item_scores.items() if score is None],
+        }
+        final_packets[packet['seed_id']] = final_packet
+
+    try:
+        # Packets are filtered concurrently, so identical prompts from different packets (e.g. the same
+        # distractor generated for two seeds) are in flight together and coalesced by llm_api.acall_llm
+        async with asyncio.TaskGroup() as tg:
+            for packet in all_deduplicated_data:
+                tg.create_task(filter_packet(packet))
+    finally:
+        final_qualified_packets = [
+            final_packets[packet['seed_id']] for packet in all_deduplicated_data if final_packets.get(packet['seed_id'])
+        ]
+        if len(final_packets) < len(all_deduplicated_data):
+            logging.warning(f"Filtering stopped early, {output_file} only holds the {len(final_packets)} packets processed so far.")
+            # Keep the entries of packets not reached yet, so their stored verdicts are reused next time
+            for seed_id, entry in stage_manifest.items():
+                new_manifest.setdefault(seed_id, entry)
+        utils.save_to_json(final_qualified_packets, output_file)
+        _save_stage_manifest(manifest_file, "filter", new_manifest)
+
+def _load_judgements(
+    judgements_file: str, stage: str, models: Optional[List[str]] = None
+) -> Dict[tuple, List[Dict[str, Any]]]:
+    """
+    Loads the stored verdicts of one stage, grouped by (item_id, item_hash).
+
+    If the same (item, model, run_index) slot was judged more than once, the latest verdict wins.
+    """
+    latest = {}
+    for record in utils.load_from_jsonl(judgements_file):
+        if record.get("stage") != stage:
+            continue
+        if models is not None and record["model"] not in models:
+            continue
+        slot = (record["item_id"], record["item_hash"], record["model"], record["run_index"])
+        latest[slot] = record
+
+    verdicts_by_item = {}
+    for (item_id, item_hash, _, _), record in latest.items():
+        verdicts_by_item.setdefault((item_id, item_hash), []).append(record)
+    return verdicts_by_item
+
+def compute_agreement_statistics(verdicts_by_item: Dict[tuple, List[Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Computes per-model statistics from stored verdicts: verdict count, rate of 'F' verdicts, parse error and
+    judge fallback rates, agreement with the panel majority of each item and agreement with the ground truth.
+    """
+    counters = {}
+    for verdicts in verdicts_by_item.values():
+        valid = [v["eval_result"] for v in verdicts if v["eval_result"] in ("T", "F")]
+        num_f = valid.count("F")
+        num_t = len(valid) - num_f
+        majority = "F" if num_f > num_t else "T" if num_t > num_f else None
+
+        for v in verdicts:
+            c = counters.setdefault(v["model"], {
+                "verdicts": 0, "judged_incorrect": 0, "errors": 0, "judge_fallbacks": 0,
+                "majority_total": 0, "majority_agree": 0, "ground_truth_total": 0, "ground_truth_agree": 0,
+            })
+            c["verdicts"] += 1
+            c["judged_incorrect"] += v["eval_result"] == "F"
+            c["errors"] += v["eval_result"] not in ("T", "F")
+            c["judge_fallbacks"] += bool(v.get("judge_fallback"))
+            if majority is not None:
+                c["majority_total"] += 1
+                c["majority_agree"] += v["eval_result"] == majority
+            expected = {"Correct": "T", "Wrong": "F"}.get(v.get("ground_truth"))
+            if expected is not None:
+                c["ground_truth_total"] += 1
+                c["ground_truth_agree"] += v["eval_result"] == expected
+
+    def rate(numerator: int, denominator: int) -> Optional[float]:
+        return round(numerator / denominator, 4) if denominator else None
+
+    return {
+        model: {
+            "verdicts": c["verdicts"],
+            "judged_incorrect_rate": rate(c["judged_incorrect"], c["verdicts"]),
+            "error_rate": rate(c["errors"], c["verdicts"]),
+            "judge_fallback_rate": rate(c["judge_fallbacks"], c["verdicts"]),
+            "majority_agreement": rate(c["majority_agree"], c["majority_total"]),
+            "ground_truth_agreement": rate(c["ground_truth_agree"], c["ground_truth_total"]),
+        }
+        for model, c in sorted(counters.items())
+    }
+
+def run_rethreshold_stage(
+    source_file: str,
+    output_file: str,
+    target: str = "filter",
+    judgements_file: str = config.JUDGEMENTS_FILE,
+    score_min: Optional[int] = None,
+    score_max: Optional[int] = None,
+    models: Optional[List[str]] = None,
+) -> None:
+    """
+    Recomputes the qualified set of a filtering stage from the stored verdicts, without any API call.
+
+    Args:
+        source_file: The stage input (DEDUPLICATED_FILE for 'filter', the seed file for 'seed_filter').
+        output_file: Where to write the re-qualified data, in the same format as the original stage.
+        target: Which stored stage to re-apply, 'filter' or 'seed_filter'.
+        judgements_file: The raw verdict store written by the filtering stages.
+        score_min: Minimum score for qualification. Defaults to the configured threshold of the stage.
+        score_max: Maximum score for qualification. Defaults to QUALIFIED_SCORE_MAX for 'filter', unbounded for seeds.
+        models: Only count verdicts of these filter models. Defaults to all stored models. The configured
+            thresholds assume every filter model is counted, so explicit thresholds are required with a subset.
+
+    The per-model agreement statistics are saved next to output_file, as <output>_agreement.json.
+    """
+    logging.info("\n" + "=" * 20 + f" RETHRESHOLD ({target.upper()}) " + "=" * 20)
+    if models and (score_min is None or (target == "filter" and score_max is None)):
+        raise ValueError("Explicit thresholds are required when only a subset of filter models is counted.")
+    if target == "filter":
+        score_min = config.QUALIFIED_SCORE_MIN if score_min is None else score_min
+        score_max = config.QUALIFIED_SCORE_MAX if score_max is None else score_max
+    elif target == "seed_filter":
+        score_min = config.SEED_QUALITY_THRESHOLD if score_min is None else score_min
+    else:
+        raise ValueError(f"Unknown rethreshold target: {target}")
+
+    source_data = utils.load_from_json(source_file)
+    if not source_data:
+        return
+    verdicts_by_item = _load_judgements(judgements_file, target, models)
+    if not verdicts_by_item:
+        logging.error(f"No stored verdicts for stage '{target}' in {judgements_file}. Aborting rethreshold.")
+        return
+    logging.info(f"Thresholds: [{score_min}, {score_max if score_max is not None else 'inf'}], "
+                 f"models: {', '.join(models) if models else 'all stored'}")
 
-    utils.save_to_json(final_qualified_packets, output_file)
+    def score_of(item_id: str, content: Dict[str, Any]) -> Optional[int]:
+        verdicts = verdicts_by_item.get((item_id, utils.hash_content(content)))
+        if not verdicts:
+            logging.warning(f"  ! No stored verdicts for item {item_id}, skipping it.")
+            return None
+        score = _item_score(verdicts)
+        if score is None:
+            logging.warning(f"  ! Item {item_id} is unjudgeable by some filter model, skipping it.")
+        return score
+
+    def qualifies(score: Optional[int]) -> bool:
+        return score is not None and score >= score_min and (score_max is None or score <= score_max)
+
+    qualified = []
+    if target == "filter":
+        for packet in source_data:
+            item_scores = {item['id']: score_of(item['id'], item['content']) for item in packet['generated_incorrect']}
+            final_packet = _qualified_packet(packet, item_scores, score_min, score_max)
+            if final_packet:
+                qualified.append(final_packet)
+        num_items = sum(len(packet['qualified_incorrect_texts']) for packet in qualified)
+        logging.info(f"Rethreshold complete, kept {len(qualified)} packets with {num_items} incorrect texts.")
+    else:
+        for seed in source_data:
+            score = score_of(seed['id'], seed['content'])
+            if qualifies(score):
+                qualified.append({**seed, "quality_score": score})
+        logging.info(f"Rethreshold complete, kept {len(qualified)} seed questions.")
+
+    agreement_statistics = compute_agreement_statistics(verdicts_by_item)
+    logging.info("-" * 40)
+    logging.info("Per-model agreement statistics:")
+    for model, stats in agreement_statistics.items():
+        logging.info(f"{model}: {stats}")
+    logging.info("-" * 40)
+
+    utils.save_to_json(qualified, output_file)
+    utils.save_to_json(agreement_statistics, os.path.splitext(output_file)[0] + "_agreement.json")
 
 
 async def run_combination_stage(qualified_file: str, output_file: str):
@@ -310,9 +713,92 @@ async def run_combination_stage(qualified_file: str, output_file: str):
     utils.save_to_json(multiple_choice_questions, output_file)
     logging.info(f"Successfully generated {len(multiple_choice_questions)} multiple choice questions, saved to {output_file}")
 
-async def run_test(input_file: str, output_file: str):
+def _render_test_prompt(question: Dict[str, Any]) -> str:
+    """Renders the prompt of one multiple choice question."""
+    options = question["options"]  # dict: {"A": ..., "B": ..., ...}
+
+    prompt = "Below is a multiple choice question. Each choice is a mathematical definition or proposition-proof pair.\n"
+    prompt += "Your task is to determine which choices are mathematically correct.\n"
+    prompt += f"Exactly {config.NUM_CORRECT_ANSWERS} choices are correct.\n\n"
+
+    # Add each option
+    for key in sorted(options.keys()):
+        prompt += f"Choice {key}:\n\n{utils.generate_one_choice(options[key])}\n\n\n"
+
+    prompt += "Output format: Put the labels of all correct choices inside a \\boxed{} at the end of your response.\n"
+    prompt += "Example: \\boxed{A,B} if you think A and B are correct."
+    return prompt
+
+def _score_test_response(model_name: str, response: str, correct_answers: set) -> float:
+    """Scores one model response against the correct choices of a question."""
+    matches = re.findall(r'\\boxed\{([^}]*)\}', response)
+    if not matches:
+        logging.warning(f"  ! No boxed answer found in response from {model_name}.")
+        return 0.0
+
+    # Extract the choices from the model's answer
+    answer_str = matches[-1].replace(" ", "")  # Remove spaces
+    model_answers = set(answer_str.split(','))
+
+    # Calculate the number of matches
+    correct_count = sum(1 for ans in model_answers if ans in correct_answers)
+    expected_count = getattr(config, "NUM_CORRECT_ANSWERS", 2)
+
+    score = correct_count / expected_count
+    logging.info(f"  => {model_name} score: {score:.2f} (Correct: {correct_count}/{expected_count})")
+    return score
+
+def _save_leaderboard(
+    avg_scores: Dict[str, Optional[float]], answered: Dict[str, int], num_questions: int, leaderboard_file: str
+) -> None:
+    """
+    Writes the leaderboard as Markdown. Only models that answered every question are ranked;
+    models with missing answers are listed separately, since their averages are not comparable.
+    """
+    complete = {model: score for model, score in avg_scores.items() if answered[model] == num_questions}
+    lines = [
+        f"| Rank | Model | Average score ({num_questions} questions) |",
+        "| --- | --- | --- |",
+    ]
+    ranked = sorted(complete.items(), key=lambda kv: kv[1], reverse=True)
+    for rank, (model, score) in enumerate(ranked, 1):
+        lines.append(f"| {rank} | {model} | {score:.4f} |")
+
+    incomplete = [model for model in avg_scores if model not in complete]
+    if incomplete:
+        lines += [
+            "",
+            "Not ranked (missing answers, re-run `--stage test` to fill them):",
+            "",
+            "| Model | Answered questions | Average over answered |",
+            "| --- | --- | --- |",
+        ]
+        for model in incomplete:
+            score = avg_scores[model]
+            score_str = "n/a" if score is None else f"{score:.4f}"
+            lines.append(f"| {model} | {answered[model]}/{num_questions} | {score_str} |")
+    try:
+        with open(leaderboard_file, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        logging.info(f"Leaderboard successfully saved to {leaderboard_file}")
+    except IOError as e:
+        logging.error(f"Failed to save leaderboard to {leaderboard_file}: {e}")
+
+async def run_test(
+    input_file: str,
+    output_file: str,
+    results_store: Optional[str] = config.TEST_RESULTS_STORE,
+    leaderboard_file: Optional[str] = config.LEADERBOARD_FILE,
+    reuse_stored: bool = True,
+):
     """
     Test the model's performance on multiple choice questions and calculate the score.
+
+    Responses are persisted in results_store, keyed by model and a content hash of the rendered question,
+    so only (model, question) pairs without a stored response are queried. Adding a model to TEST_MODELS
+    therefore costs exactly that model's calls. With reuse_stored=False every pair is queried again, and the
+    new responses still replace the stored ones. Pairs whose call failed are reported as missing (score None)
+    rather than counted as wrong answers; models with missing answers are left out of the leaderboard ranking.
     """
     logging.info("\n" + "=" * 20 + " TESTING MODELS ON MULTIPLE CHOICE QUESTIONS " + "=" * 20)
 
@@ -322,92 +808,96 @@ async def run_test(input_file: str, output_file: str):
         logging.warning("No questions found. Aborting test stage.")
         return
 
-    # Prepare output structure
-    results = []
+    # Load stored responses, the latest one wins for each (model, prompt_hash)
+    stored_responses = {}
+    if results_store and reuse_stored:
+        for record in utils.load_from_jsonl(results_store):
+            stored_responses[(record["model"], record["prompt_hash"])] = record["response"]
+
+    async def query_model(model_name: str, messages: List[Dict[str, str]]):
+        try:
+            response = await llm_api.acall_llm(model_name, messages)
+            logging.info(f"  + Response from {model_name}: {response[:100]}...")  # Print the beginning part
+            return response
+        except Exception as e:
+            logging.error(f"  ! Error querying {model_name}: {e}")
+            return None
 
-    # Iterate through each question
-    for idx, question in enumerate(questions):
+    async def test_question(idx: int, question: Dict[str, Any]):
         logging.info(f"\n--- Testing Question {idx} ---")
 
-        # Construct prompt
-        options = question["options"]  # dict: {"A": ..., "B": ..., ...}
         correct_answers = set(question["answer"])  # list: ["A", "C"]
-
-        # Construct prompt
-        prompt = "Below is a multiple choice question. Each choice is a mathematical definition or proposition-proof pair.\n"
-        prompt += "Your task is to determine which choices are mathematically correct.\n"
-        prompt += f"Exactly {config.NUM_CORRECT_ANSWERS} choices are correct.\n\n"
-
-        # Add each option
-        for key in sorted(options.keys()):
-            prompt += f"Choice {key}:\n\n{utils.generate_one_choice(options[key])}\n\n\n"
-
-        prompt += "Output format: Put the labels of all correct choices inside a \\boxed{} at the end of your response.\n"
-        prompt += "Example: \\boxed{A,B} if you think A and B are correct."
-
-        # Asynchronously call all models
+        prompt = _render_test_prompt(question)
+        prompt_hash = utils.hash_text(prompt)
         messages = [{"role": "user", "content": prompt}]
 
-        async def query_model(model_name: str):
-            try:
-                response = await asyncio.to_thread(llm_api.call_llm, model_name, messages)
-                logging.info(f"  + Response from {model_name}: {response[:100]}...")  # Print the beginning part
-                return response
-            except Exception as e:
-                logging.error(f"  ! Error querying {model_name}: {e}")
-                return ""
-
-        # Concurrently query all models
-        responses = await asyncio.gather(*[query_model(model) for model in config.TEST_MODELS])
+        # Concurrently query only the models without a stored response
+        missing_models = [model for model in config.TEST_MODELS if (model, prompt_hash) not in stored_responses]
+        if len(missing_models) < len(config.TEST_MODELS):
+            logging.info(f"  Reusing {len(config.TEST_MODELS) - len(missing_models)} stored responses.")
+        responses = await asyncio.gather(*[query_model(model, messages) for model in missing_models])
+
+        new_records = []
+        for model_name, response in zip(missing_models, responses):
+            if response is None:
+                continue  # Failed calls are not stored, so they are retried on the next run
+            stored_responses[(model_name, prompt_hash)] = response
+            new_records.append({"model": model_name, "prompt_hash": prompt_hash, "response": response})
+        if results_store and new_records:
+            utils.append_to_jsonl(new_records, results_store)
 
         # Parse responses and calculate scores
-        model_responses = dict(zip(config.TEST_MODELS, responses))
-        model_scores = {}
-
-        for model_name, response in model_responses.items():
-            matches = re.findall(r'\\boxed\{([^}]*)\}', response)
-            if not matches:
-                logging.warning(f"  ! No boxed answer found in response from {model_name}.")
-                model_scores[model_name] = 0.0
-                continue
-
-            # Extract the choices from the model's answer
-            answer_str = matches[-1].replace(" ", "")  # Remove spaces
-            model_answers = set(answer_str.split(','))
-
-            # Calculate the number of matches
-            correct_count = sum(1 for ans in model_answers if ans in correct_answers)
-            expected_count = getattr(config, "NUM_CORRECT_ANSWERS", 2)
-
-            score = correct_count / expected_count
-            model_scores[model_name] = score
-
-            logging.info(f"  => {model_name} score: {score:.2f} (Correct: {correct_count}/{expected_count})")
+        model_responses = {
+            model: stored_responses.get((model, prompt_hash)) for model in config.TEST_MODELS
+        }
+        model_scores = {
+            model_name: None if response is None else _score_test_response(model_name, response, correct_answers)
+            for model_name, response in model_responses.items()
+        }
 
         # Record results
-        results.append({
+        return len(missing_models), {
             "question_index": idx,
+            "prompt_hash": prompt_hash,
             "model_responses": model_responses,
             "score": model_scores
-        })
+        }
 
-    # Calculate the average score for each model
+    # Questions are tested concurrently, so identical rendered questions are in flight together and
+    # coalesced by llm_api.acall_llm; gather keeps the results in question order
+    outcomes = await asyncio.gather(*[test_question(idx, question) for idx, question in enumerate(questions)])
+    num_queried = sum(count for count, _ in outcomes)
+    results = [result for _, result in outcomes]
+
+    logging.info(f"Queried {num_queried} new (model, question) pairs out of {len(questions) * len(config.TEST_MODELS)}.")
+
+    # Calculate the average score for each model over the questions it answered
     total_scores = {model: 0.0 for model in config.TEST_MODELS}
+    answered = {model: 0 for model in config.TEST_MODELS}
     for result in results:
         for model, score in result["score"].items():
+            if score is None:
+                continue
             total_scores[model] += score
+            answered[model] += 1
 
     avg_scores = {
-        model: round(score / len(questions), 4)
+        model: round(score / answered[model], 4) if answered[model] else None
         for model, score in total_scores.items()
     }
+    for model, count in answered.items():
+        if count < len(questions):
+            logging.warning(f"  ! {model} is missing {len(questions) - count} answers (failed calls), re-run to fill them.")
 
     logging.info("\n" + "-" * 40)
     logging.info("Final model average scores:")
     for model, score in avg_scores.items():
-        logging.info(f"{model}: {score}")
+        coverage = "" if answered[model] == len(questions) else f" (incomplete: {answered[model]}/{len(questions)} answered)"
+        logging.info(f"{model}: {score}{coverage}")
     logging.info("-" * 40)
 
     # Save results
     utils.save_to_json(results, output_file)
-    logging.info(f"✅ Test results have been saved to {output_file}")
\ No newline at end of file
+    logging.info(f"✅ Test results have been saved to {output_file}")
+    if leaderboard_file:
+        _save_leaderboard(avg_scores, answered, len(questions), leaderboard_file)
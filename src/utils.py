@@ -1,12 +1,15 @@
 
 """Contains utility functions, such as file operations, content parsing, etc."""
 
+import hashlib
 import json
 import logging
 import os
 import re
 from typing import List, Dict, Any, Optional, Literal
 
+from src import prompts
+
 def save_to_json(data: Any, filepath: str) -> None:
     """Saves data to a JSON file."""
     try:
@@ -28,6 +31,39 @@ def load_from_json(filepath: str) -> Any:
         logging.error(f"Error decoding JSON from {filepath}: {e}")
         return None
 
+def append_to_jsonl(records: List[Dict[str, Any]], filepath: str) -> None:
+    """Appends records to a JSONL file, one JSON object per line."""
+    try:
+        with open(filepath, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except IOError as e:
+        logging.error(f"Failed to append data to {filepath}: {e}")
+
+def load_from_jsonl(filepath: str) -> List[Dict[str, Any]]:
+    """Loads all records from a JSONL file. Returns an empty list if the file does not exist."""
+    if not os.path.exists(filepath):
+        return []
+    records = []
+    with open(filepath, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                logging.error(f"Skipping malformed line {line_no} in {filepath}: {e}")
+    return records
+
+def hash_text(text: str) -> str:
+    """Returns the SHA-256 hex digest of a string."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def hash_content(content: Any) -> str:
+    """Returns a stable SHA-256 hex digest of any JSON-serializable object."""
+    return hash_text(json.dumps(content, sort_keys=True, ensure_ascii=False))
+
 def parse_generated_items(text: str) -> List[str]:
     """Parses all incorrect versions from the output of the generation model."""
     return re.findall(r'\[incorrect_(?:proof|definition)_\d-start\]\s*(.*?)\s*\[incorrect_(?:proof|definition)_\d-end\]', text, re.DOTALL)
@@ -37,6 +73,23 @@ def parse_eval_result(text: str) -> str:
     match = re.search(r'\\boxed\{([^}]*(T|F)[^}]*)\}', text)
     return match.group(1) if match else "Error"
 
+def format_eval_prompt(item_type: str, content: Dict[str, str]) -> str:
+    """Builds the evaluation prompt asking a filter model to judge one definition or proposition-proof pair."""
+    if item_type == 'proposition-proof':
+        return f"{prompts.PROOF_EVAL_PROMPT}\n{content['proposition']}\n\nHere is the proof:\n\n{content['proof']}"
+    elif item_type == 'definition':
+        return f"{prompts.DEFINITION_EVAL_PROMPT}\n{content['text']}"
+    else:
+        raise ValueError(f"Unknown item type: {item_type}")
+
+def generate_one_choice(option: Dict[str, Any]) -> str:
+    """Renders one option of a multiple choice question (a definition or a proposition-proof pair) as text."""
+    content = option.get('content', option)
+    item_type = option.get('type', 'proposition-proof' if 'proof' in content else 'definition')
+    if item_type == 'definition':
+        return f"Definition:\n\n{content['text']}"
+    return f"Proposition:\n\n{content['proposition']}\n\nProof:\n\n{content['proof']}"
+
 def normalize_text(text: str) -> str:
     """Removes all spaces and newlines for deduplication comparison."""
     return re.sub(r'\s+', '', text)